@@ -1,26 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
 import json
 import logging
 import os
+import random
+import time
+from dataclasses import dataclass, fields
+from typing import TYPE_CHECKING, Any, Self
 
 import nodriver as uc  # type: ignore[import-untyped]
+from nodriver.core.connection import (  # type: ignore[import-untyped]
+    ProtocolException,
+)
 from sinch import SinchClient  # type: ignore[import-untyped]
 from sinch.core.exceptions import SinchException  # type: ignore[import-untyped]
 
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+try:
+    # orjson parses the availability payload several times faster than the stdlib.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # Configure logging at the module level
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+# Seconds to wait between availability checks while the API response is steady.
+POLL_INTERVAL = 300
+# After the response changes, poll this often (in seconds), then ease back to
+# POLL_INTERVAL by this factor per unchanged response.
+POLL_MIN_INTERVAL = 60
+POLL_BACKOFF_FACTOR = 1.2
+# Up to this many seconds are randomly added to or removed from each wait.
+POLL_JITTER = 15
+# Bounds, in seconds, of the exponential backoff after a bad API response.
+RETRY_MIN_DELAY = 60
+RETRY_MAX_DELAY = 600
+
+# The "Make a Reservation" button, which is only shown to logged-in users.
+RESERVATION_BUTTON_SELECTOR = (
+    'a[data-testid="button"][href="/myaccount/reservations/add/"]'
+)
+# Seconds to wait before each check for that button after submitting the login
+# form (about 6 seconds in all).
+LOGIN_CHECK_DELAYS = (0.2, 0.4, 0.8, 1.6, 3.2)
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Settings for main(), each read from the environment variable of the same
+    name, upper-cased. See main() for what each one holds.
+    """
+
+    # Ikon + Chrome
+    chrome_data_dir: str
+    login_email: str
+    login_password: str
+    login_url: str
+    fetch_url: str
+    desired_dates: str
+
+    # Sinch
+    sinch_key_id: str
+    sinch_key_secret: str
+    sinch_project_id: str
+    sinch_from_number: str
+    sinch_to_numbers: str
+
+    @classmethod
+    def from_env(cls) -> Self:
+        """
+        Builds a Config from the environment.
+
+        Raises a ValueError listing every variable that's missing or empty.
+        """
+        env = {f.name: os.environ.get(f.name.upper(), "") for f in fields(cls)}
+        missing = [name.upper() for name, value in env.items() if not value]
+        if missing:
+            raise ValueError(", ".join(missing))
+        return cls(**env)
+
+
+def _csv(value: str) -> list[str]:
+    """
+    Splits a comma-separated string, dropping whitespace and empty entries.
+    """
+    return list(filter(None, map(str.strip, value.split(","))))
+
 
 def send_sinch_sms(
     sinch_client: SinchClient,
     from_number: str,
     to_numbers: list[str],
     body: str,
-) -> None:
+) -> bool:
     """
-    Sends an SMS message using the official Sinch Python SDK.
+    Sends an SMS message using the official Sinch Python SDK. Returns whether the
+    message was sent.
     """
     try:
         response = sinch_client.sms.batches.send(
@@ -37,6 +121,63 @@ def send_sinch_sms(
         )
     except SinchException as exc:
         logger.warning("Failed to send to %s. Error: %s", ", ".join(to_numbers), exc)
+        return False
+    return True
+
+
+def find_availability(
+    passes: Iterable[dict[str, Any]],
+    desired_dates: frozenset[str],
+) -> dict[str, list[str]]:
+    """
+    Maps the ID of each pass that can still be reserved to its desired dates that
+    are open, skipping passes with none open.
+    """
+    availability_found: dict[str, list[str]] = {}
+
+    # Only proceed with passes you can still make reservations for
+    reservable_passes = (p for p in passes if p.get("reservations_available", 0) >= 1)
+
+    for pass_info in reservable_passes:
+        pass_id = pass_info.get("id")
+        if pass_id is None:
+            logger.debug("Skipping pass with no id: %s", pass_info)
+            continue
+
+        # A date is "available" if it's not closed / blackout / unavailable
+        # (any of these lists may be missing or null)
+        blocked_dates = frozenset(pass_info.get("closed_dates") or ()).union(
+            pass_info.get("blackout_dates") or (),
+            pass_info.get("unavailable_dates") or (),
+        )
+
+        open_dates = sorted(desired_dates - blocked_dates)
+        if open_dates:
+            availability_found[str(pass_id)] = open_dates
+
+    return availability_found
+
+
+async def wait_to_retry(problem: str, retry_delay: int) -> int:
+    """
+    Logs `problem`, sleeps for `retry_delay` seconds, and returns the delay to use
+    if the next attempt fails too (doubled, up to RETRY_MAX_DELAY).
+    """
+    logger.warning("%s Will retry in %d seconds.", problem, retry_delay)
+    await asyncio.sleep(retry_delay)
+    return min(retry_delay * 2, RETRY_MAX_DELAY)
+
+
+async def sleep_before_next_check(seconds: float, check_started_at: float) -> None:
+    """
+    Sleeps until about `seconds` after `check_started_at` (a time.monotonic()
+    reading), so time spent on the check itself doesn't push later checks back.
+    The wait is randomly adjusted by up to POLL_JITTER either way.
+    """
+    delay = check_started_at + seconds - time.monotonic()
+    delay = max(0, delay + random.uniform(-POLL_JITTER, POLL_JITTER))
+    logger.info("Sleeping for %d seconds before the next check...", delay)
+    await asyncio.sleep(delay)
 
 
 async def main() -> None:
@@ -63,67 +204,25 @@ async def main() -> None:
       • SINCH_TO_NUMBERS
     """
 
-    # Fetch configuration from environment variables (Ikon + Chrome)
-    chrome_data_dir = os.environ.get("CHROME_DATA_DIR")
-
-    login_email = os.environ.get("LOGIN_EMAIL")
-    login_password = os.environ.get("LOGIN_PASSWORD")
-    login_url = os.environ.get("LOGIN_URL")
-    fetch_url = os.environ.get("FETCH_URL")
-    desired_dates_str = os.environ.get("DESIRED_DATES")
-
-    # Fetch configuration from environment variables (Sinch)
-    sinch_key_id = os.environ.get("SINCH_KEY_ID")
-    sinch_key_secret = os.environ.get("SINCH_KEY_SECRET")
-    sinch_project_id = os.environ.get("SINCH_PROJECT_ID")
-    sinch_from_number = os.environ.get("SINCH_FROM_NUMBER")
-    sinch_to_numbers_str = os.environ.get("SINCH_TO_NUMBERS")
-
-    # Collect and check for missing or empty env vars
-    required_env_vars = {
-        "CHROME_DATA_DIR": chrome_data_dir,
-        "LOGIN_EMAIL": login_email,
-        "LOGIN_PASSWORD": login_password,
-        "LOGIN_URL": login_url,
-        "FETCH_URL": fetch_url,
-        "DESIRED_DATES": desired_dates_str,
-        "SINCH_KEY_ID": sinch_key_id,
-        "SINCH_KEY_SECRET": sinch_key_secret,
-        "SINCH_PROJECT_ID": sinch_project_id,
-        "SINCH_FROM_NUMBER": sinch_from_number,
-        "SINCH_TO_NUMBERS": sinch_to_numbers_str,
-    }
-    missing_env_vars = [k for k, v in required_env_vars.items() if not v]
-    if missing_env_vars:
+    # Fetch configuration from environment variables
+    try:
+        config = Config.from_env()
+    except ValueError as exc:
         logger.error(
             "The following environment variables are missing or empty: %s. Exiting.",
-            ", ".join(missing_env_vars),
+            exc,
         )
         return
 
-    # Make mypy happy by asserting that all required env vars are non-None.
-    assert (
-        chrome_data_dir
-        and login_email
-        and login_password
-        and login_url
-        and fetch_url
-        and desired_dates_str
-        and sinch_key_id
-        and sinch_key_secret
-        and sinch_project_id
-        and sinch_from_number
-        and sinch_to_numbers_str
-    )
-
-    # Parse desired dates
-    DESIRED_DATES = [d.strip() for d in desired_dates_str.split(",") if d.strip()]
+    # Parse desired dates into a set, so each pass can be checked with one set
+    # difference
+    DESIRED_DATES = frozenset(_csv(config.desired_dates))
     if not DESIRED_DATES:
         logger.error("DESIRED_DATES environment variable is empty or invalid. Exiting.")
         return
 
     # Parse phone number list
-    SINCH_TO_NUMBERS = [p.strip() for p in sinch_to_numbers_str.split(",") if p.strip()]
+    SINCH_TO_NUMBERS = _csv(config.sinch_to_numbers)
     if not SINCH_TO_NUMBERS:
         logger.error(
             "SINCH_TO_NUMBERS environment variable is empty or invalid. Exiting."
@@ -132,35 +231,33 @@ async def main() -> None:
 
     # Create the Sinch client
     sinch_client = SinchClient(
-        key_id=sinch_key_id,
-        key_secret=sinch_key_secret,
-        project_id=sinch_project_id,
+        key_id=config.sinch_key_id,
+        key_secret=config.sinch_key_secret,
+        project_id=config.sinch_project_id,
     )
 
     # Start the "nodriver" browser in undetected Chrome mode
-    browser = await uc.start(user_data_dir=chrome_data_dir)
+    browser = await uc.start(user_data_dir=config.chrome_data_dir)
 
     #
     # 1. Log in.
     #
-    tab = await browser.get(login_url)
+    tab = await browser.get(config.login_url)
 
     # Optional wait in case the session auto-redirects, etc.
     await tab.sleep(3)
 
     # Check if "Make a Reservation" button is present to detect logged-in state
-    reservation_btn = await tab.query_selector(
-        'a[data-testid="button"][href="/myaccount/reservations/add/"]'
-    )
+    reservation_btn = await tab.query_selector(RESERVATION_BUTTON_SELECTOR)
 
     if reservation_btn:
         logger.info("It appears we are already logged in. Skipping login steps.")
     else:
-        # Proceed with login steps
-        email_input = await tab.select('input[name="email"]')
-        password_input = await tab.select('input[name="password"]')
-        login_button = await tab.select(
-            'button[type="submit"][class*="button"]:not(:empty)'
+        # Proceed with login steps, looking up the (independent) fields concurrently
+        email_input, password_input, login_button = await asyncio.gather(
+            tab.select('input[name="email"]'),
+            tab.select('input[name="password"]'),
+            tab.select('button[type="submit"][class*="button"]:not(:empty)'),
         )
 
         if not email_input or not password_input or not login_button:
@@ -170,20 +267,24 @@ async def main() -> None:
             return
 
         # Fill in login credentials
-        await email_input.send_keys(login_email)
-        await password_input.send_keys(login_password)
+        await email_input.send_keys(config.login_email)
+        await password_input.send_keys(config.login_password)
 
         # Click the "Log In" button
         await login_button.click()
 
-        # Optional: wait for post-login transitions or captchas
-        await tab.sleep(5)
-
-        # After logging in, try to find the "Make a Reservation" button again
-        reservation_btn = await tab.query_selector(
-            'a[data-testid="button"][href="/myaccount/reservations/add/"]'
-        )
-        if not reservation_btn:
+        # After logging in, look for the "Make a Reservation" button again, backing
+        # off to allow for post-login transitions or captchas
+        for delay in LOGIN_CHECK_DELAYS:
+            await tab.sleep(delay)
+            try:
+                reservation_btn = await tab.query_selector(RESERVATION_BUTTON_SELECTOR)
+            except ProtocolException:
+                # The document changed mid-query, e.g. during the post-login redirect
+                continue
+            if reservation_btn:
+                break
+        else:
             logger.error("Failed to locate 'Make a Reservation' button after login.")
             await tab.sleep(3)
             browser.stop()
@@ -191,81 +292,119 @@ async def main() -> None:
 
     logger.info("Login successful (or already logged in). Beginning repeated checks...")
 
+    # The JavaScript used to fetch availability data never changes, so build it once.
+    # json.dumps quotes and escapes the URL as a valid JavaScript string literal.
+    fetch_js = f"""
+        fetch({json.dumps(config.fetch_url)}, {{
+          method: "GET",
+          credentials: "include"
+        }})
+        .then(r => r.text());
+        """
+
+    # The availability in the last alert sent, or {} once it has gone away, to
+    # avoid repeating alerts
+    reported_availability: dict[str, list[str]] = {}
+
+    # Digest of the last good API response, and how long to wait after this one
+    prev_digest: bytes | None = None
+    poll_interval: float = POLL_INTERVAL
+
+    # Doubles after each consecutive bad response, resets after a good one
+    retry_delay = RETRY_MIN_DELAY
+
     while True:
+        check_started_at = time.monotonic()
+
         #
         # 2. Perform a raw fetch request via JavaScript to get Ikon availability data
         #
-        result = await tab.evaluate(
-            f"""
-            fetch("{fetch_url}", {{
-              method: "GET",
-              credentials: "include"
-            }})
-            .then(r => r.text());
-            """,
-            await_promise=True,
-        )
+        # A rejected fetch (e.g. a network error) raises ProtocolException
+        try:
+            result = await tab.evaluate(fetch_js, await_promise=True)
+        except ProtocolException as exc:
+            retry_delay = await wait_to_retry(f"API fetch failed: {exc}.", retry_delay)
+            continue
+
+        # An empty body comes back as None rather than text
+        if not isinstance(result, str):
+            retry_delay = await wait_to_retry(
+                f"Unexpected result from API fetch: {result!r}.", retry_delay
+            )
+            continue
+
+        # Most polls get back exactly what the last one did, which has already been
+        # parsed and reported on, so skip straight to the next check
+        digest = hashlib.blake2b(result.encode(), digest_size=16).digest()
+        if digest == prev_digest:
+            # The same as the last good response, so this one is good too
+            retry_delay = RETRY_MIN_DELAY
+            logger.info("Availability data is unchanged since the last check.")
+            poll_interval = min(poll_interval * POLL_BACKOFF_FACTOR, POLL_INTERVAL)
+            await sleep_before_next_check(poll_interval, check_started_at)
+            continue
 
         #
         # 3. Parse the JSON and check for dates of interest
         #
         try:
-            data = json.loads(result)
+            data = json_loads(result)
         except json.JSONDecodeError:
-            logger.warning("Unable to parse JSON from API. Will retry in 5 minutes.")
-            await tab.sleep(300)
+            retry_delay = await wait_to_retry(
+                "Unable to parse JSON from API.", retry_delay
+            )
             continue
 
-        logger.debug("Received JSON data: %s", data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received JSON data: %s", data)
 
         if "data" not in data:
-            logger.warning("JSON has no top-level 'data' key. Will retry in 5 minutes.")
-            await tab.sleep(300)
+            retry_delay = await wait_to_retry(
+                "JSON has no top-level 'data' key.", retry_delay
+            )
             continue
 
-        # We'll collect availability information here
-        availability_found: dict[str, list[str]] = {}
-
-        for pass_info in data["data"]:
-            pass_id = pass_info.get("id")
-            # Only proceed if you can still make reservations for this pass
-            if pass_info.get("reservations_available", 0) < 1:
-                continue
+        retry_delay = RETRY_MIN_DELAY
 
-            closed_dates = pass_info.get("closed_dates", [])
-            blackout_dates = pass_info.get("blackout_dates", [])
-            unavailable_dates = pass_info.get("unavailable_dates", [])
+        # Changes tend to come in bursts (e.g. cancellations being snapped up), so
+        # poll more often right after one. The first response isn't a change.
+        poll_interval = POLL_INTERVAL if prev_digest is None else POLL_MIN_INTERVAL
+        prev_digest = digest
 
-            for date_str in DESIRED_DATES:
-                # Mark date "available" if not in closed / blackout / unavailable
-                if (
-                    date_str not in closed_dates
-                    and date_str not in blackout_dates
-                    and date_str not in unavailable_dates
-                ):
-                    availability_found.setdefault(pass_id, []).append(date_str)
+        availability_found = find_availability(data["data"], DESIRED_DATES)
 
-        if availability_found:
+        if not availability_found:
+            logger.info("No availability found for desired dates.")
+            reported_availability = {}
+        elif availability_found == reported_availability:
+            # Other parts of the response changed, but not what we alert on
+            logger.info("Availability is unchanged since the last alert.")
+        else:
             # Build a summary message for all found availability
-            lines = ["Found availability for these pass IDs and dates:"]
-            for pid, dates in availability_found.items():
-                lines.append(f"  - Pass ID {pid}: {dates}")
-
-            msg_text = "\n".join(lines)
+            msg_text = "Found availability for these pass IDs and dates:\n" + "\n".join(
+                f"  - Pass ID {pid}: {dates}"
+                for pid, dates in availability_found.items()
+            )
             logger.info(msg_text)
 
-            # Send an SMS to each recipient
-            send_sinch_sms(
+            # Send an SMS to every recipient in one batch. The Sinch SDK is
+            # synchronous, so run it in a thread to keep the browser connection's
+            # event loop responsive while the request is in flight.
+            sent = await asyncio.to_thread(
+                send_sinch_sms,
                 sinch_client,
-                sinch_from_number,
+                config.sinch_from_number,
                 SINCH_TO_NUMBERS,
                 msg_text,
             )
-        else:
-            logger.info("No availability found for desired dates.")
-
-        logger.info("Sleeping for 5 minutes before the next check...")
-        await tab.sleep(300)
+            if sent:
+                reported_availability = availability_found
+            else:
+                # Forget this response, so the next poll parses it and alerts again
+                # even if nothing has changed
+                prev_digest = None
+
+        await sleep_before_next_check(poll_interval, check_started_at)
 
     # No browser.stop() here – we never exit the loop unless manually interrupted.
 